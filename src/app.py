@@ -39,40 +39,39 @@
 # So that's where we are now, and it works!  Doesn't load my good ol' Raspberry
 # no more.
 
-import abc
-from collections import namedtuple
-from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
+import functools
 from http import HTTPStatus
 import json
 import os
 import pwd
 import re
-import shlex
-import socket
-import subprocess
-from subprocess import DEVNULL, PIPE, STDOUT
+import sys
+import threading
+import time
 import traceback
 import urllib.parse
 
-
-def split_by(xs, sep):
-    group = []
-    for x in xs:
-        if x == sep:
-            yield group
-            group = []
-        else:
-            group.append(x)
-    yield group
+try:
+    # orjson is a lot faster than json, use it if it's available.
+    import orjson
+except ImportError:
+    orjson = None
 
 
 class Response:
     DEFAULT_STATUS = HTTPStatus.OK
+    # See write_to_request_handler().
+    SINGLE_WRITE_MAX = 64 * 1024
 
     @staticmethod
     def body_from_json(body):
-        return json.dumps(body, ensure_ascii=False, indent=4)
+        # The responses are consumed by the page's JavaScript, not by humans,
+        # so they're not indented: that would only inflate them.
+        if orjson is not None:
+            # orjson produces UTF-8 bytes right away, no need to encode them.
+            return orjson.dumps(body)
+        return json.dumps(body, ensure_ascii=False, separators=(',', ':'))
 
     def __init__(self, body, status=None):
         if status is None:
@@ -84,6 +83,10 @@ class Response:
         yield 'Content-Type', 'text/html; charset=utf-8'
 
     def encode_body(self):
+        if self.body is None:
+            return b''
+        if isinstance(self.body, bytes):
+            return self.body
         return self.body.encode(errors='replace')
 
     def write_as_cgi_script(self):
@@ -98,44 +101,143 @@ class Response:
 
     def write_body_as_cgi_script(self):
         if self.body is not None:
-            print(self.body)
+            sys.stdout.flush()
+            sys.stdout.buffer.write(self.encode_body() + b'\n')
 
     def write_to_request_handler(self, handler):
-        handler.send_response(self.status)
-        self.write_headers_to_request_handler(handler)
-        self.write_body_to_request_handler(handler)
-
-    def write_headers_to_request_handler(self, handler):
+        # send_response/send_header/end_headers flush the headers in one
+        # write and then the body goes out in another.  Small responses (like
+        # /top or /thermal) are sent in one go instead.  /status can run into
+        # hundreds of KB though, and copying all of that just to save a single
+        # send() isn't worth it.
+        body = self.encode_body()
+        handler.log_request(self.status.value)
+        headers = self.headers_for_request_handler(handler, body)
+        if len(body) <= Response.SINGLE_WRITE_MAX:
+            handler.wfile.write(headers + body)
+        else:
+            handler.wfile.write(headers)
+            handler.wfile.write(body)
+
+    def headers_for_request_handler(self, handler, body):
+        lines = [
+            f'{handler.protocol_version} {self.status.value} {self.status.phrase}',
+            f'Server: {handler.version_string()}',
+            f'Date: {handler.date_time_string()}',
+        ]
         for name, val in self.headers():
-            handler.send_header(name, val)
-        handler.end_headers()
-
-    def write_body_to_request_handler(self, handler):
-        if self.body is not None:
-            handler.wfile.write(self.encode_body())
-
-
-def run_do(*args, **kwargs):
-    output = subprocess.run(args, stdin=DEVNULL, stdout=PIPE, stderr=STDOUT, universal_newlines=True, **kwargs)
+            lines.append(f'{name}: {val}')
+        # The body is encoded in full beforehand anyway, so the client might
+        # as well know its length instead of waiting for EOF.
+        lines.append(f'Content-Length: {len(body)}')
+        lines.append('')
+        lines.append('')
+        return '\r\n'.join(lines).encode('latin-1', 'strict')
+
+
+# A /status request spawns a few processes per systemd instance.  Starting all
+# of them at once on a single-core board like the Pi only makes them fight
+# over the CPU, so cap the number of commands running at the same time.
+# systemctl & journalctl mostly wait for systemd though, so even a single core
+# runs 5 of them at once (as many as the old thread pool did on the Pi).
+MAX_PROCESSES = max(5, min(8, (os.cpu_count() or 1) * 2))
+
+# Creating a new event loop for every request is a waste, so a single loop
+# runs in its own thread for the lifetime of the server, and the request
+# handler threads submit their work to it.
+#
+# Importing asyncio takes about as long as all the other imports combined,
+# and the CGI script doesn't need it to serve /top or /thermal.  That's why
+# asyncio is imported (and the loop is started) only when the first command
+# is about to run.  Use the functions below to get to asyncio & subprocess.
+event_loop = None
+event_loop_lock = threading.Lock()
+process_slots = None
+
+
+def _asyncio():
+    import asyncio
+    return asyncio
+
+
+def _subprocess():
+    import subprocess
+    return subprocess
+
+
+async def new_semaphore(value):
+    # Before Python 3.10, asyncio primitives bind to the current event loop
+    # when constructed, so this has to be done by the loop itself.
+    return _asyncio().Semaphore(value)
+
+
+def start_event_loop():
+    global event_loop, process_slots
+    with event_loop_lock:
+        if event_loop is not None:
+            return event_loop
+        asyncio = _asyncio()
+        loop = asyncio.new_event_loop()
+        thread = threading.Thread(target=loop.run_forever, name='event_loop', daemon=True)
+        thread.start()
+        process_slots = asyncio.run_coroutine_threadsafe(new_semaphore(MAX_PROCESSES), loop).result()
+        event_loop = loop
+        return event_loop
+
+
+def run_until_complete(coro):
+    loop = event_loop or start_event_loop()
+    return _asyncio().run_coroutine_threadsafe(coro, loop).result()
+
+
+@functools.lru_cache(maxsize=None)
+def which(executable):
+    import shutil
+    return shutil.which(executable)
+
+
+async def run_do(*args, env=None):
+    # fork() + exec() of the whole Python process is expensive on the Pi.
+    # subprocess can use posix_spawn() instead, but only if close_fds is off
+    # and the executable is given as a path.  Not closing the descriptors is
+    # fine, since Python makes them non-inheritable by default anyway.
+    executable = which(args[0]) or args[0]
+    subprocess = _subprocess()
+    # The commands are pure waits on a child process, no need to block a
+    # thread on each of them.
+    async with process_slots:
+        proc = await _asyncio().create_subprocess_exec(executable, *args[1:], stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env, close_fds=False)
+        output, _ = await proc.communicate()
+    # The output ends up in a UTF-8 response anyway, decode it exactly once;
+    # a stray invalid byte in some journal line must not fail the request.
+    output = output.decode(errors='replace')
     # Include the output in the exception's message:
     try:
-        output.check_returncode()
+        subprocess.CompletedProcess(args, proc.returncode, output).check_returncode()
     except Exception as e:
-        raise RuntimeError("Command's output was this:\n" + output.stdout) from e
-    return output.stdout
+        raise RuntimeError("Command's output was this:\n" + output) from e
+    return output
 
 
-class Task(abc.ABC):
+class Task:
     def complete(self):
-        self.run()
+        run_until_complete(self.run())
         return Response(Response.body_from_json(self.result()))
 
-    @abc.abstractmethod
-    def run(self):
-        pass
+    async def run(self):
+        raise NotImplementedError
 
-    @abc.abstractmethod
     def result(self):
+        raise NotImplementedError
+
+
+class LocalTask(Task):
+    # A task that doesn't run any commands, and does all of its work in
+    # result().  Completing it on its own doesn't need the event loop.
+    def complete(self):
+        return Response(Response.body_from_json(self.result()))
+
+    async def run(self):
         pass
 
 
@@ -148,53 +250,69 @@ class TaskList(Task):
             raise RuntimeError(f'duplicate task name: {name}')
         self.tasks[name] = task
 
-    def run(self):
-        for task in self.tasks.values():
-            task.run()
+    async def run(self):
+        await _asyncio().gather(*(task.run() for task in self.tasks.values()))
 
     def result(self):
         return {name: task.result() for name, task in self.tasks.items()}
 
 
-pool = ThreadPoolExecutor()
-
-
-def run(*args, **kwargs):
-    return pool.submit(run_do, *args, **kwargs)
-
-
 class Command(Task):
+    # Output of the commands that don't mind being a bit stale is shared
+    # between requests.  Maps the arguments to (expiry time, output).
+    CACHE = {}
+
     def __init__(self, *args):
         self.args = args
         self.env = None
+        # Seconds to cache the output for, None to always run the command.
+        self.ttl = None
 
-    def run(self):
-        self.task = run(*self.args, env=self.env)
-        return self.task
+    async def run(self):
+        if self.ttl is None:
+            self.output = await run_do(*self.args, env=self.env)
+            return
+        now = time.monotonic()
+        cached = Command.CACHE.get(self.args)
+        if cached is not None and now < cached[0]:
+            self.output = cached[1]
+            return
+        self.output = await run_do(*self.args, env=self.env)
+        Command.CACHE[self.args] = (now + self.ttl, self.output)
 
     def result(self):
-        return self.task.result()
+        return self.output
 
     def now(self):
-        return self.run().result()
+        run_until_complete(self.run())
+        return self.result()
 
 
 class Systemd(Command):
+    # The environment never changes, so there's no need to copy it for every
+    # command.  It's shared between the commands, and must not be modified.
+    ENV = {**os.environ, 'SYSTEMD_PAGER': '', 'SYSTEMD_COLORS': 'no'}
+    # Set by version() once `systemctl --version` succeeds.  A failure isn't
+    # remembered, so that a one-off hiccup doesn't stick for the lifetime of the
+    # server.
+    VERSION = None
+
     def __init__(self, *args):
         super().__init__(*args)
-        self.env = self.make_env()
-
-    @staticmethod
-    def make_env():
-        env = os.environ.copy()
-        env['SYSTEMD_PAGER'] = ''
-        env['SYSTEMD_COLORS'] = 'no'
-        return env
+        self.env = Systemd.ENV
 
     @staticmethod
     def su(user, cmd):
+        # Unlike `su -c`, runuser executes the command directly: no need to
+        # quote it into a shell string, and no shell to parse it.
+        if which('runuser'):
+            new = Systemd('runuser', '-u', user.name, '--', *cmd.args)
+            new.env = Systemd.fix_su_env(user, cmd.env)
+            return new
+        # runuser comes with util-linux, which some systems might not have.
+        import shlex
         new = Systemd('su', '-c', shlex.join(cmd.args), user.name)
-        new.env = Systemd.fix_su_env(user, cmd.env.copy())
+        new.env = Systemd.fix_su_env(user, cmd.env)
         return new
 
     @staticmethod
@@ -204,11 +322,29 @@ class Systemd(Command):
         # https://unix.stackexchange.com/q/423632
         # https://unix.stackexchange.com/q/245768
         # https://unix.stackexchange.com/q/434494
-        env['XDG_RUNTIME_DIR'] = user.runtime_dir
         # I'm not sure the bus part works everywhere.
         bus_path = os.path.join(user.runtime_dir, 'bus')
-        env['DBUS_SESSION_BUS_ADDRESS'] = 'unix:path=' + bus_path
-        return env
+        # The environment passed in is shared, don't modify it.
+        return {
+            **env,
+            'XDG_RUNTIME_DIR': user.runtime_dir,
+            'DBUS_SESSION_BUS_ADDRESS': 'unix:path=' + bus_path,
+        }
+
+    @staticmethod
+    def version():
+        if Systemd.VERSION is not None:
+            return Systemd.VERSION
+        # The first line is something like "systemd 247 (247.3-7+deb11u4)".
+        try:
+            output = Systemd('systemctl', '--version').now()
+        except Exception:
+            return 0
+        match = re.match(r'^systemd (\d+)', output)
+        if match is None:
+            return 0
+        Systemd.VERSION = int(match.group(1))
+        return Systemd.VERSION
 
 
 class Ctl(Systemd):
@@ -228,79 +364,79 @@ class Systemctl(Ctl):
     def __init__(self, *args):
         super().__init__('systemctl', *args)
 
+    # Since systemd 248, root can talk to any user instance directly using the
+    # USER@.host syntax, without going through su, PAM & the shell.
+    MACHINE_MIN_VERSION = 248
 
-class Journalctl(Ctl):
-    def __init__(self, *args):
-        super().__init__('journalctl', *args)
+    @classmethod
+    def machine(cls, user, *args):
+        return cls.user(f'--machine={user.name}@.host', *args)
+
+    @staticmethod
+    def supports_machine():
+        return Systemd.version() >= Systemctl.MACHINE_MIN_VERSION
 
 
-class Loginctl(Systemd):
+class Journalctl(Ctl):
     def __init__(self, *args):
-        super().__init__('loginctl', *args, '--full')
+        super().__init__('journalctl', *args)
 
 
-class Docker(Command):
-    def __init__(self, *args):
-        super().__init__('docker', *args)
+class Docker:
+    # This used to run `docker ps` & `docker inspect`, paying for the Go
+    # runtime's startup twice per request.  The Docker Engine API is served
+    # over a Unix socket, so we can just talk to the daemon directly.
+    SOCKET = '/var/run/docker.sock'
 
+    @staticmethod
+    @functools.lru_cache(maxsize=1)
+    def socket_path():
+        host = os.environ.get('DOCKER_HOST')
+        if not host:
+            return Docker.SOCKET
+        if host.startswith('unix://'):
+            return host[len('unix://'):]
+        # The docker CLI could also talk to tcp:// & ssh:// hosts.  Rather than
+        # silently falling back to the local daemon, don't show Docker at all.
+        print(f'Unsupported DOCKER_HOST, Docker status is disabled: {host}', file=sys.stderr)
+        return None
 
-class DockerVersion(Docker):
-    def __init__(self, *args):
-        super().__init__('version')
+    @staticmethod
+    async def get(path):
+        reader, writer = await _asyncio().open_unix_connection(Docker.socket_path())
+        try:
+            # HTTP/1.0: the daemon closes the connection after the response,
+            # and doesn't use chunked encoding.
+            writer.write(f'GET {path} HTTP/1.0\r\nHost: docker\r\n\r\n'.encode())
+            response = await reader.read()
+        finally:
+            writer.close()
+        head, _, body = response.partition(b'\r\n\r\n')
+        status = head.split(b'\r\n', 1)[0].split()
+        if len(status) < 2 or status[1] != b'200':
+            raise RuntimeError(f'Docker API request {path} failed:\n' + response.decode(errors='replace'))
+        return body
 
     @staticmethod
     def is_daemon_running():
+        if Docker.socket_path() is None:
+            return False
         try:
-            DockerVersion().now()
+            run_until_complete(Docker.get('/_ping'))
             return True
         except:
             return False
 
 
-class DockerPs(Docker):
-    def __init__(self, *args):
-        super().__init__('ps', *args)
-
-    @staticmethod
-    def quiet(*args):
-        return DockerPs('--quiet', *args)
-
-    @staticmethod
-    def get_all_ids():
-        cmd = DockerPs.quiet('--all')
-        return cmd.now().splitlines()
-
-
-class DockerInspect(Docker):
-    # This is pretty cool.  I wanted to separate container entries with \0, and
-    # this is the best I could come up with.  Note that a newline still gets
-    # added at the end.
-    FORMAT = '{{printf "%s%c" (json .) 0}}'
-
-    def __init__(self, *args):
-        super().__init__('inspect', f'--format={DockerInspect.FORMAT}', *args)
-
-
-class DockerStatus(DockerInspect):
-    def __init__(self):
-        self.containers = DockerPs.get_all_ids()
-        super().__init__(*self.containers)
-
-    def run(self):
-        if not self.containers:
-            # `docker inspect` requires at least one container argument.
-            return ''
-        return super().run()
+class DockerStatus(Task):
+    async def run(self):
+        containers = json.loads(await Docker.get('/containers/json?all=1'))
+        # The container list lacks the exit code, the health status, etc.
+        infos = await _asyncio().gather(*(Docker.get(f"/containers/{container['Id']}/json") for container in containers))
+        self.containers = [DockerStatus.filter_info(json.loads(info)) for info in infos]
 
     def result(self):
-        if not self.containers:
-            # `docker inspect` requires at least one container argument.
-            return []
-        result = super().result()
-        result = result.split('\0')
-        result = [json.loads(info) for info in result if info.strip()]
-        result = [DockerStatus.filter_info(info) for info in result]
-        return result
+        return self.containers
 
     @staticmethod
     def filter_info(info):
@@ -316,15 +452,13 @@ class DockerStatus(DockerInspect):
         }
 
 
-class Hostname(Task):
-    def run(self):
-        pass
-
+class Hostname(LocalTask):
     def result(self):
+        import socket
         return socket.gethostname()
 
 
-class ThermalInfo(Task):
+class ThermalInfo(LocalTask):
     ROOT = '/sys/class/thermal'
 
     @staticmethod
@@ -375,64 +509,243 @@ class ThermalInfo(Task):
             'type': ThermalInfo._read_type(dir),
         }
 
-    def run(self):
-        pass
-
     def result(self):
         return [self._read_dir(dir) for dir in ThermalInfo._collect_dirs()]
 
 
-class Top(Command):
-    COMMAND = None
+class Top(LocalTask):
+    # This used to run `top -b -n 1`, which on the Pi takes quite a bit of time
+    # to start up & format its report.  The report is built from /proc
+    # directly now, in the same format.
+    PROC = '/proc'
+    CLK_TCK = os.sysconf('SC_CLK_TCK')
+    PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+    HEADER = '    PID USER      PR  NI    VIRT    RES    SHR S  %CPU  %MEM     TIME+ COMMAND'
 
-    def __init__(self):
-        super().__init__(*Top.get_command())
+    # Resolving UIDs to names is relatively expensive, and they rarely change.
+    USER_NAMES = {}
+
+    # Like top between refreshes, CPU usage is computed since the previous
+    # snapshot: (uptime, CPU times, {(PID, start time): ticks}).
+    SNAPSHOT = None
+    # Shorter intervals give too noisy numbers.
+    MIN_INTERVAL = 0.2
+
+    @staticmethod
+    def _read(path):
+        # /proc/PID/stat includes the process's name, which can be any bytes
+        # at all; a stray invalid byte must not fail the request.
+        with open(path, errors='replace') as fd:
+            return fd.read()
+
+    @staticmethod
+    def _read_meminfo():
+        meminfo = {}
+        for line in Top._read(os.path.join(Top.PROC, 'meminfo')).splitlines():
+            name, value = line.split(':', 1)
+            # The values are in KiB.
+            meminfo[name] = int(value.split()[0])
+        return meminfo
+
+    @staticmethod
+    def _read_cpu_times():
+        # user nice system idle iowait irq softirq steal, in ticks.
+        line = Top._read(os.path.join(Top.PROC, 'stat')).splitlines()[0]
+        return [int(x) for x in line.split()[1:9]]
+
+    @staticmethod
+    def _user_name(uid):
+        name = Top.USER_NAMES.get(uid)
+        if name is None:
+            try:
+                name = pwd.getpwuid(uid).pw_name
+            except KeyError:
+                name = str(uid)
+            Top.USER_NAMES[uid] = name
+        return name
+
+    @staticmethod
+    def _read_process(pid):
+        dir = os.path.join(Top.PROC, pid)
+        uid = os.stat(dir).st_uid
+        stat = Top._read(os.path.join(dir, 'stat'))
+        statm = Top._read(os.path.join(dir, 'statm'))
+        # The command name is in parentheses, and might contain anything,
+        # including spaces & parentheses.
+        comm = stat[stat.index('(') + 1:stat.rindex(')')]
+        fields = stat[stat.rindex(')') + 2:].split()
+        return {
+            'pid': int(pid),
+            'user': Top._user_name(uid),
+            'state': fields[0],
+            'ticks': int(fields[11]) + int(fields[12]),
+            'priority': int(fields[15]),
+            'nice': int(fields[16]),
+            'start': int(fields[19]) / Top.CLK_TCK,
+            'virt': int(fields[20]),
+            'res': int(fields[21]) * Top.PAGE_SIZE,
+            'shr': int(statm.split()[2]) * Top.PAGE_SIZE,
+            'comm': comm,
+        }
+
+    @staticmethod
+    def _read_processes():
+        processes = []
+        for entry in os.scandir(Top.PROC):
+            if not entry.name.isdigit():
+                continue
+            try:
+                processes.append(Top._read_process(entry.name))
+            except OSError:
+                # The process has exited while we were looking.
+                continue
+        return processes
+
+    @staticmethod
+    def _format_uptime(uptime):
+        mins = int(uptime) // 60
+        days, mins = divmod(mins, 24 * 60)
+        hours, mins = divmod(mins, 60)
+        result = 'up '
+        if days:
+            result += f'{days} day{"s" if days != 1 else ""}, '
+        if hours:
+            result += f'{hours:2}:{mins:02}'
+        else:
+            result += f'{mins} min'
+        return result
+
+    @staticmethod
+    def _format_summary(uptime, processes, cpu_times, meminfo):
+        load = Top._read(os.path.join(Top.PROC, 'loadavg')).split()[:3]
+        now = time.strftime('%H:%M:%S')
+        lines = [f'top - {now} {Top._format_uptime(uptime)},  load average: {", ".join(load)}']
+
+        states = [process['state'] for process in processes]
+        running = states.count('R')
+        stopped = states.count('T') + states.count('t')
+        zombie = states.count('Z')
+        sleeping = len(states) - running - stopped - zombie
+        lines.append(f'Tasks: {len(states):3} total, {running:3} running, {sleeping:3} sleeping, {stopped:3} stopped, {zombie:3} zombie')
+
+        total = sum(cpu_times) or 1
+        cpu = [100 * ticks / total for ticks in cpu_times]
+        names = 'us', 'sy', 'ni', 'id', 'wa', 'hi', 'si', 'st'
+        # /proc/stat has them in the user, nice, system order.
+        cpu[1], cpu[2] = cpu[2], cpu[1]
+        lines.append('%Cpu(s):' + ','.join(f'{pct:5.1f} {name}' for pct, name in zip(cpu, names)))
+
+        mib = lambda kib: kib / 1024
+        mem_total = meminfo['MemTotal']
+        mem_free = meminfo['MemFree']
+        buff_cache = meminfo['Buffers'] + meminfo['Cached'] + meminfo.get('SReclaimable', 0)
+        mem_used = mem_total - mem_free - buff_cache
+        lines.append(f'MiB Mem : {mib(mem_total):8.1f} total, {mib(mem_free):8.1f} free, {mib(mem_used):8.1f} used, {mib(buff_cache):8.1f} buff/cache')
+        swap_total = meminfo['SwapTotal']
+        swap_free = meminfo['SwapFree']
+        swap_used = swap_total - swap_free
+        mem_avail = meminfo.get('MemAvailable', mem_free)
+        lines.append(f'MiB Swap: {mib(swap_total):8.1f} total, {mib(swap_free):8.1f} free, {mib(swap_used):8.1f} used. {mib(mem_avail):8.1f} avail Mem')
+        return lines
+
+    @staticmethod
+    def _format_time(ticks):
+        hundredths = ticks * 100 // Top.CLK_TCK
+        secs, hundredths = divmod(hundredths, 100)
+        mins, secs = divmod(secs, 60)
+        return f'{mins}:{secs:02}.{hundredths:02}'
 
     @staticmethod
-    def get_command():
-        # On more modern versions of top, we want to enable memory scaling
-        # from the command line (another option is the rc file, but that's too
-        # complicated).  For that, we simply run `top -h` once, and check if
-        # the output contains the flags we want to use.
-        if Top.COMMAND is not None:
-            return Top.COMMAND
-        help_output = run_do('top', '-h')
-        args = ['top', '-b', '-n', '1', '-w', '512']
-        memory_scaling_args = ['-E', 'm', '-e', 'm']
-        if 'Ee' in help_output:
-            args += memory_scaling_args
+    def _format_process(process, mem_total):
+        mib = lambda size: f'{size / 1024 / 1024:.1f}m'
+        user = process['user']
+        if len(user) > 8:
+            user = user[:7] + '+'
+        return (f"{process['pid']:7} {user:<8} {process['priority']:3} {process['nice']:3} "
+                f"{mib(process['virt']):>7} {mib(process['res']):>6} {mib(process['shr']):>6} "
+                f"{process['state']} {process['cpu']:5.1f} {100 * process['res'] / 1024 / mem_total:5.1f} "
+                f"{Top._format_time(process['ticks']):>9} {process['comm']}")
+
+    def result(self):
+        uptime = float(Top._read(os.path.join(Top.PROC, 'uptime')).split()[0])
+        processes = Top._read_processes()
+        cpu_times = Top._read_cpu_times()
+        meminfo = Top._read_meminfo()
+        ticks = {(process['pid'], process['start']): process['ticks'] for process in processes}
+
+        prev = Top.SNAPSHOT
+        if prev is not None and uptime - prev[0] >= Top.MIN_INTERVAL:
+            prev_uptime, prev_cpu_times, prev_ticks = prev
+            interval = uptime - prev_uptime
+            for process in processes:
+                # Processes that have started since then have 0 previous ticks.
+                delta = process['ticks'] - prev_ticks.get((process['pid'], process['start']), 0)
+                process['cpu'] = 100 * delta / Top.CLK_TCK / interval
+            cpu_delta = [now - then for now, then in zip(cpu_times, prev_cpu_times)]
+            Top.SNAPSHOT = (uptime, cpu_times, ticks)
         else:
-            if '-E, ' in help_output and '-e, ' in help_output:
-                args += memory_scaling_args
-        Top.COMMAND = args
-        return Top.COMMAND
+            for process in processes:
+                # Without a previous snapshot to compare against, this is the
+                # average since the process has started (like ps does it).
+                elapsed = uptime - process['start']
+                process['cpu'] = 100 * process['ticks'] / Top.CLK_TCK / elapsed if elapsed > 0 else 0.
+            # And since boot for the whole system.
+            cpu_delta = cpu_times
+            if prev is None:
+                Top.SNAPSHOT = (uptime, cpu_times, ticks)
+        processes.sort(key=lambda process: (-process['cpu'], process['pid']))
+
+        lines = Top._format_summary(uptime, processes, cpu_delta, meminfo)
+        lines.append('')
+        lines.append(Top.HEADER)
+        lines += [Top._format_process(process, meminfo['MemTotal']) for process in processes]
+        return '\n'.join(lines) + '\n'
 
 
 class Reboot(Command):
+    ARGS = ('systemctl', 'reboot')
+
     def __init__(self):
-        super().__init__('systemctl', 'reboot')
+        super().__init__(*Reboot.ARGS)
 
 
 class Poweroff(Command):
+    ARGS = ('systemctl', 'poweroff')
+
     def __init__(self):
-        super().__init__('systemctl', 'poweroff')
+        super().__init__(*Poweroff.ARGS)
 
 
 class InstanceStatus(TaskList):
+    # The arguments are the same for every instance & every request.
+    SYSTEMCTL_ARGS = {
+        'overview': ('status',),
+        'failed': ('list-units', '--failed'),
+        'timers': ('list-timers', '--all'),
+    }
+    JOURNALCTL_ARGS = {
+        'journal': ('-b', '--lines=20'),
+    }
+    # Failed units and timers change rarely, so it's fine to reuse what
+    # another request has fetched a few seconds ago.
+    CACHED = ('failed', 'timers')
+    CACHE_TTL = 5
+
     def __init__(self, systemctl, journalctl):
-        tasks = {
-            'overview': systemctl('status'),
-            'failed': systemctl('list-units', '--failed'),
-            'timers': systemctl('list-timers', '--all'),
-            'journal': journalctl('-b', '--lines=20'),
-        }
+        tasks = {}
+        for name, args in InstanceStatus.SYSTEMCTL_ARGS.items():
+            tasks[name] = systemctl(*args)
+        for name, args in InstanceStatus.JOURNALCTL_ARGS.items():
+            tasks[name] = journalctl(*args)
+        for name in InstanceStatus.CACHED:
+            tasks[name].ttl = InstanceStatus.CACHE_TTL
         super().__init__(tasks)
 
 
 class SystemStatus(InstanceStatus):
     def __init__(self):
         super().__init__(Systemctl.system, Journalctl.system)
-        if DockerVersion.is_daemon_running():
+        if Docker.is_daemon_running():
             self.add('docker', DockerStatus())
 
 
@@ -442,7 +755,14 @@ class UserStatus(InstanceStatus):
 
     @staticmethod
     def su(user):
-        systemctl = lambda *args: Systemd.su(user, Systemctl.user(*args))
+        if Systemctl.supports_machine():
+            systemctl = lambda *args: Systemctl.machine(user, *args)
+        else:
+            # Older systemd versions (Debian 11 has 247, for example) don't
+            # support USER@.host.
+            systemctl = lambda *args: Systemd.su(user, Systemctl.user(*args))
+        # journalctl doesn't support USER@.host, it still needs to switch
+        # users.
         journalctl = lambda *args: Systemd.su(user, Journalctl.user(*args))
         return UserStatus(systemctl, journalctl)
 
@@ -472,10 +792,27 @@ class Status(TaskList):
         super().__init__(tasks)
 
 
-User = namedtuple('User', ['uid', 'name'])
-SystemdUser = namedtuple('SystemdUser', ['uid', 'name', 'runtime_dir'])
+class User:
+    __slots__ = 'uid', 'name'
+
+    def __init__(self, uid, name):
+        self.uid = uid
+        self.name = name
 
 
+class SystemdUser(User):
+    __slots__ = 'runtime_dir',
+
+    def __init__(self, uid, name, runtime_dir):
+        super().__init__(uid, name)
+        self.runtime_dir = runtime_dir
+
+
+# The process's UIDs don't change, and neither (for our purposes) does the
+# passwd database, so the functions below only do the lookups once.
+
+
+@functools.lru_cache(maxsize=1)
 def running_as_root():
     # AFAIK, Python's http.server drops root privileges and executes the scripts
     # as user nobody.
@@ -483,13 +820,17 @@ def running_as_root():
     return os.geteuid() == 0 or running_as_nobody()
 
 
+@functools.lru_cache(maxsize=1)
 def running_as_nobody():
-    for user in users():
-        if user.name == 'nobody':
-            return user.uid == os.geteuid()
-    return False
+    # Look the user up by name instead of walking the entire passwd database
+    # (which might be slow with LDAP & co.).
+    try:
+        return pwd.getpwnam('nobody').pw_uid == os.geteuid()
+    except KeyError:
+        return False
 
 
+@functools.lru_cache(maxsize=1)
 def get_current_user():
     uid = os.getuid()
     entry = pwd.getpwuid(uid)
@@ -509,70 +850,27 @@ def user_instance_active(user):
         return False
 
 
-# A pitiful attempt to find a list of possibly-systemd-enabled users follows
-# (i.e. users that might be running a per-user systemd instance).
-# I don't know of a better way than probing /run/user/UID.
-# Maybe running something like `loginctl list-sessions` would be better?
-
-# These are the default values, see [1].
-# The actual values are specified in /etc/login.defs.
-# Still, they can be overridden on the command line, so I don't think there
-# actually is a way to list non-system users (imma call them "human").
-#
-#   [1]: https://man7.org/linux/man-pages/man8/useradd.8.html
-UID_MIN = 1000
-UID_MAX = 60000
-
-
-def users():
-    for entry in pwd.getpwall():
-        yield User(entry.pw_uid, entry.pw_name)
-
+# systemd_users() lists the users that might be running a per-user systemd
+# instance.  I used to run `loginctl list-users` & `loginctl show-user` for
+# this, but that's two processes for what logind itself keeps in /run/user: it
+# creates /run/user/UID (the user's runtime directory) for every user that's
+# logged in or lingering, i.e. exactly the users that are running a systemd
+# instance.
+RUNTIME_ROOT = '/run/user'
 
-def human_users():
-    for user in users():
-        if user.uid < UID_MIN:
-            continue
-        if user.uid > UID_MAX:
-            continue
-        yield user
 
-
-# You know what, loginctl might just be the answer.
-# Namely, `loginctl list-users`: during my testing, it did only list the users
-# that were running a systemd instance.
 def systemd_users():
-    def list_users():
-        output = Loginctl('list-users', '--no-legend').now()
-        lines = output.splitlines()
-        if not lines:
-            return
-        for line in lines:
-            # This assumes user names cannot contain spaces.
-            # loginctl list-users output must be in the UID NAME format.
-            info = line.lstrip().split(' ', 2)
-            if len(info) < 2:
-                raise RuntimeError(f'invalid `loginctl list-users` output:\n{output}')
-            uid, user = info[0], info[1]
-            yield User(uid, user)
-
-    def show_users(users):
-        user_args = [user.name for user in users]
-        if not user_args:
-            return None
-        properties = 'UID', 'Name', 'RuntimePath'
-        prop_args = (arg for prop in properties for arg in ('-p', prop))
-        output = Loginctl('show-user', *prop_args, '--value', *user_args).now()
-        lines = output.splitlines()
-        # Assuming that for muptiple users, the properties will be separated by
-        # an empty string.
-        groups = split_by(lines, '')
-        for group in groups:
-            if len(group) != len(properties):
-                raise RuntimeError(f'invalid `loginctl show-user` output:\n{output}')
-            yield SystemdUser(int(group[0]), group[1], group[2])
-
-    return show_users(list_users())
+    try:
+        names = os.listdir(RUNTIME_ROOT)
+    except FileNotFoundError:
+        return
+    uids = sorted(int(name) for name in names if name.isdigit())
+    for uid in uids:
+        try:
+            entry = pwd.getpwuid(uid)
+        except KeyError:
+            continue
+        yield SystemdUser(uid, entry.pw_name, os.path.join(RUNTIME_ROOT, str(uid)))
 
 
 def cgi_one_value(params, name, default=None):
@@ -586,6 +884,31 @@ def cgi_one_value(params, name, default=None):
     return values[0]
 
 
+class InFlightResponse:
+    # A response that one thread is processing and the others are waiting for.
+    # Not a concurrent.futures.Future: importing that pulls in logging.
+    __slots__ = 'done', 'response', 'error'
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+    def set_response(self, response):
+        self.response = response
+        self.done.set()
+
+    def set_error(self, error):
+        self.error = error
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.response
+
+
 class Request(Enum):
     STATUS = 'status'
     TOP = 'top'
@@ -611,26 +934,92 @@ class Request(Enum):
         return request
 
     def process(self):
-        if self is Request.STATUS:
-            return Status().complete()
-        if self is Request.TOP:
-            return Top().complete()
-        if self is Request.THERMAL:
-            return ThermalInfo().complete()
-
         if self in [Request.REBOOT, Request.POWEROFF] and self.disable_power:
             return Response(None, HTTPStatus.FORBIDDEN)
-        if self is Request.REBOOT:
-            return Reboot().complete()
-        if self is Request.POWEROFF:
-            return Poweroff().complete()
-
-        raise NotImplementedError(f'unknown request: {self}')
+        if self in CACHED_REQUESTS and RESPONSE_TTL > 0:
+            return self.process_cached()
+        return self.process_do()
+
+    def process_cached(self):
+        with response_cache_lock:
+            cached = response_cache.get(self)
+            if cached is not None and time.monotonic() < cached[0]:
+                return cached[1]
+            # If another thread is already processing the same request, wait
+            # for its response instead of spawning the same processes again.
+            in_flight = responses_in_flight.get(self)
+            if in_flight is None:
+                in_flight = responses_in_flight[self] = InFlightResponse()
+                owner = True
+            else:
+                owner = False
+        if not owner:
+            return in_flight.wait()
+        try:
+            response = self.process_do()
+            # Cache the encoded body so that it's not encoded again on every hit.
+            response.body = response.encode_body()
+        except BaseException as e:
+            with response_cache_lock:
+                del responses_in_flight[self]
+            in_flight.set_error(e)
+            raise
+        # Processing might take a while on the Pi, only count the TTL from the
+        # moment the response is ready.
+        with response_cache_lock:
+            response_cache[self] = (time.monotonic() + RESPONSE_TTL, response)
+            del responses_in_flight[self]
+        in_flight.set_response(response)
+        return response
+
+    def process_do(self):
+        task = REQUEST_TASKS.get(self)
+        if task is None:
+            raise NotImplementedError(f'unknown request: {self}')
+        return task().complete()
+
+
+REQUEST_TASKS = {
+    Request.STATUS: Status,
+    Request.TOP: Top,
+    Request.THERMAL: ThermalInfo,
+    Request.REBOOT: Reboot,
+    Request.POWEROFF: Poweroff,
+}
+
+# Every open dashboard polls /status & /top on its own.  Responses to these
+# are reused for a couple of seconds, so that a few clients polling at once
+# don't each spawn the whole bunch of processes.  Set LINUX_STATUS_TTL to 0
+# to disable this.
+#
+# Only the server enables this: a CGI script serves a single request, there's
+# nothing to reuse.
+CACHED_REQUESTS = {Request.STATUS, Request.TOP}
+DEFAULT_RESPONSE_TTL = 2
+RESPONSE_TTL = 0
+# Maps the request to (expiry time, response).
+response_cache = {}
+# Maps the request to the InFlightResponse being processed right now.
+responses_in_flight = {}
+response_cache_lock = threading.Lock()
+
+
+def enable_response_cache():
+    global RESPONSE_TTL
+    ttl = os.environ.get('LINUX_STATUS_TTL')
+    if ttl is None:
+        RESPONSE_TTL = DEFAULT_RESPONSE_TTL
+        return
+    try:
+        RESPONSE_TTL = float(ttl)
+    except ValueError:
+        print(f'Invalid LINUX_STATUS_TTL value, using the default: {ttl}', file=sys.stderr)
+        RESPONSE_TTL = DEFAULT_RESPONSE_TTL
 
 
 def process_cgi_request():
     try:
-        request = Request.from_query_string(os.environ['QUERY_STRING'])
+        request = Request.from_query_string(os.environ.get('QUERY_STRING', ''))
         request.process().write_as_cgi_script()
     except:
         status = HTTPStatus.INTERNAL_SERVER_ERROR
@@ -15,7 +15,7 @@ import os
 import sys
 import traceback
 
-from app import Request, Response
+from app import Request, Response, enable_response_cache
 
 
 DEFAULT_PORT = 18101
@@ -81,6 +81,7 @@ def parse_args(args=None):
 def main(args=None):
     args = parse_args(args)
     RequestHandler.ARGS = args
+    enable_response_cache()
 
     # It's a failsafe; the script is not allowed to serve a random current
     # working directory.